@@ -1,15 +1,27 @@
+import os
+# 必须在导入torch之前设置：使用可扩展段减少长时间训练中的显存碎片
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True,max_split_size_mb:128')
 import torch
-from transformers import BertTokenizer, BertForSequenceClassification, AdamW
-from torch.utils.data import DataLoader, Dataset
+from transformers import BertTokenizerFast, BertForSequenceClassification
+from torch.utils.data import DataLoader, Dataset, Sampler
+from torch.optim import AdamW
 import pandas as pd
 from tqdm import tqdm
 import random
+from functools import partial
+import math
 import torch.nn as nn
 import torch.nn.functional as F
-import os
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 import numpy as np
 from torchmetrics import PearsonCorrCoef
 
+# Ampere及以上GPU使用TF32张量核进行矩阵乘法，并让cuDNN自动选择最快的算法
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+
 
 def create_hierarchical_penalty_matrix(num_classes, thegma):
     """
@@ -32,38 +44,36 @@ class CombinedLoss(nn.Module):
         self.alpha = alpha
         self.beta = beta  # 新增参数beta用于调节两个loss的权重
         self.thegma = thegma 
-        # 预计算罚分矩阵
-        self.penalty_matrix = create_hierarchical_penalty_matrix(num_classes, thegma)
+        # 预计算罚分矩阵，注册为非持久buffer：随loss_func.to(device)移动，且不写入state_dict
+        self.register_buffer('penalty_matrix', create_hierarchical_penalty_matrix(num_classes, thegma), persistent=False)
 
     def forward(self, logits, targets):
-        # 确保罚分矩阵与logits在同一个设备上
-        self.penalty_matrix = self.penalty_matrix.to(logits.device)
-        
-        # 计算标准的交叉熵损失
-        ce_loss = F.cross_entropy(logits, targets, reduction='none')
-        
+        # 混合精度下logits可能为bf16，相关系数对数值精度敏感，统一转为fp32计算
+        logits = logits.float()
+
+        # 只计算一次log概率；罚分矩阵对角线为1，交叉熵项已包含在加权log概率中
+        log_probs = F.log_softmax(logits, dim=1)
+
         # 根据真实类别收集每个预测对应的罚分
         penalties = self.penalty_matrix[targets, :]
-        
+
         # 应用罚分到log概率上
-        log_probs = F.log_softmax(logits, dim=1)
         weighted_log_probs = penalties * log_probs
         
         # 计算最终的加权log概率损失
         structured_contrastive_loss = -torch.sum(weighted_log_probs, dim=1).mean()
 
         # 计算Pearson相关损失
-        logits_flat = logits.view(-1)
-        targets_one_hot = F.one_hot(targets, num_classes=self.num_classes).float()
-        targets_flat = targets_one_hot.view(-1)
-        
-        logits_mean = logits_flat.mean()
-        targets_mean = targets_flat.mean()
-        
-        logits_centered = logits_flat - logits_mean
-        targets_centered = targets_flat - targets_mean
-        
-        correlation = torch.sum(logits_centered * targets_centered) / (torch.sqrt(torch.sum(logits_centered ** 2)) * torch.sqrt(torch.sum(targets_centered ** 2)))
+        # 展平的logits与one-hot目标之间的相关系数，用闭式解计算，不构造one-hot张量：
+        # one-hot均值恒为1/C，中心化后的点积等于真实类别logit之和减去 B*logits均值，
+        # 中心化one-hot的范数为 sqrt(B*(C-1)/C)
+        batch_size = logits.size(0)
+        logits_mean = logits.mean()
+        logits_centered_norm = torch.linalg.vector_norm(logits - logits_mean)
+        targets_centered_norm = math.sqrt(batch_size * (self.num_classes - 1) / self.num_classes)
+        centered_dot = logits.gather(1, targets.unsqueeze(1)).sum() - batch_size * logits_mean
+
+        correlation = centered_dot / (logits_centered_norm.clamp_min(1e-8) * targets_centered_norm)
         pearson_loss = -correlation
 
         # 结合两种损失
@@ -89,7 +99,14 @@ empathy_groups = [0, 1, 2,3,4,5, 6,7, 8,9, 10]
 # turn discrete values into classes
 def value_to_class(bins, groups, df_name, column_name):
     class_col = column_name + "Class"
-    df_name[class_col] = pd.cut(df_name[column_name], bins, labels=groups)
+    values = df_name[column_name].to_numpy(dtype=np.float64)
+    bins_arr = np.asarray(bins, dtype=np.float64)
+    # 与pd.cut(右闭区间)一致的向量化实现：对右边界做二分查找
+    bin_index = np.searchsorted(bins_arr[1:], values, side='left')
+    # 区间外的值(含NaN)与pd.cut相同记为缺失，使用可空的Int8类型
+    out_of_range = ~((values > bins_arr[0]) & (values <= bins_arr[-1]))
+    classes = np.asarray(groups, dtype=np.int8)[np.where(out_of_range, 0, bin_index)]
+    df_name[class_col] = pd.arrays.IntegerArray(classes, mask=out_of_range)
 
 
 # train, get class labels
@@ -103,17 +120,29 @@ value_to_class(empathy_bins, empathy_groups, df_dev, 'Empathy')
 
 
 # online loading:
-# tokenizer = BertTokenizer.from_pretrained('bert-base-chinese')
+# tokenizer = BertTokenizerFast.from_pretrained('bert-base-chinese')
 # model = BertForSequenceClassification.from_pretrained('bert-base-chinese')
 
 # local loading:
-tokenizer = BertTokenizer.from_pretrained('/root/bert-base-uncased')
+tokenizer = BertTokenizerFast.from_pretrained('/root/bert-base-uncased')
 model = BertForSequenceClassification.from_pretrained('/root/bert-base-uncased', num_labels=len(emotionalPolarity_groups))
+# 只需要logits，不返回各层的hidden states和attention
+model.config.output_attentions = False
+model.config.output_hidden_states = False
+model.config.return_dict = True
+
+# 冻结词嵌入层和底部的编码层，只微调上层编码层与分类头
+num_frozen_layers = 8
+model.bert.embeddings.requires_grad_(False)
+for name, param in model.named_parameters():
+    if name.startswith('bert.encoder.layer.') and int(name.split('.')[3]) < num_frozen_layers:
+        param.requires_grad_(False)
 
 # random the order of samples
+# 多进程训练时各进程需得到相同的样本顺序，因此固定random_state
 random.seed(42)
-df = df.sample(frac=1).reset_index(drop=True)
-df_dev = df_dev.sample(frac=1).reset_index(drop=True)
+df = df.sample(frac=1, random_state=42).reset_index(drop=True)
+df_dev = df_dev.sample(frac=1, random_state=42).reset_index(drop=True)
 
 
 # # 数据集中1为正面，0为反面
@@ -122,68 +151,192 @@ class Task2Dataset(Dataset):
         self.dataframe = dataframe
         self.tokenizer = tokenizer
         self.max_length = max_length
+        # 一次性批量分词，避免每个epoch在__getitem__中重复分词；不做填充，由collate_fn按批动态填充
+        encoding = tokenizer(dataframe['text'].tolist(), truncation=True, max_length=max_length)
+        self.input_ids = encoding['input_ids']
+        self.lengths = [len(ids) for ids in self.input_ids]
+        self.labels = torch.as_tensor(dataframe['EmotionalPolarity'].values, dtype=torch.long)
 
     def __len__(self):
         return len(self.dataframe)
 
     def __getitem__(self, idx):
-        text = self.dataframe.iloc[idx]['text']
-        label = self.dataframe.iloc[idx]['EmotionalPolarity']
-        encoding = self.tokenizer(text, padding='max_length', truncation=True, max_length=self.max_length, return_tensors='pt')
         return {
-            'input_ids': encoding['input_ids'].flatten(),
-            'attention_mask': encoding['attention_mask'].flatten(),
-            'labels': torch.tensor(label, dtype=torch.long)
+            'input_ids': self.input_ids[idx],
+            'labels': self.labels[idx]
         }
 
 
+def collate_fn(batch, tokenizer):
+    # 填充到当前批次中最长的序列，并取8的倍数：限制不同形状的数量，同时对齐张量核
+    encoding = tokenizer.pad([{'input_ids': item['input_ids']} for item in batch], padding=True, pad_to_multiple_of=8, return_tensors='pt')
+    return {
+        'input_ids': encoding['input_ids'],
+        'attention_mask': encoding['attention_mask'],
+        'labels': torch.stack([item['labels'] for item in batch])
+    }
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Yield batches of indices with similar sequence lengths to reduce padding.
+    Indices are shuffled, sorted by length inside pools of pool_size batches,
+    chunked into batches, and the batch order is shuffled again. With
+    num_replicas > 1 every rank takes an equal share of the batches.
+    """
+    def __init__(self, lengths, batch_size, pool_size=50, num_replicas=1, rank=0, seed=42):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _all_batches(self):
+        # 所有进程使用相同的随机种子，保证划分一致
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.lengths), generator=generator).tolist()
+        pool = self.batch_size * self.pool_size
+        batches = []
+        for start in range(0, len(indices), pool):
+            chunk = sorted(indices[start:start + pool], key=lambda i: self.lengths[i])
+            batches.extend(chunk[i:i + self.batch_size] for i in range(0, len(chunk), self.batch_size))
+        order = torch.randperm(len(batches), generator=generator).tolist()
+        return [batches[i] for i in order]
+
+    def __iter__(self):
+        batches = self._all_batches()
+        # 各进程的批次数必须相同，否则DDP会在梯度同步时挂起
+        num_batches = len(batches) // self.num_replicas
+        return iter(batches[self.rank:num_batches * self.num_replicas:self.num_replicas])
+
+    def __len__(self):
+        pool = self.batch_size * self.pool_size
+        full_pools, remainder = divmod(len(self.lengths), pool)
+        num_batches = full_pools * self.pool_size + (remainder + self.batch_size - 1) // self.batch_size
+        return num_batches // self.num_replicas
+
+
+class DataPrefetcher:
+    """
+    Copy the next batch to the device on a side CUDA stream while the current
+    batch is being computed. Returns None once the loader is exhausted.
+    """
+    def __init__(self, loader, device):
+        self.loader = iter(loader)
+        self.device = device
+        self.stream = torch.cuda.Stream() if device.type == 'cuda' else None
+        self.preload()
+
+    def preload(self):
+        try:
+            batch = next(self.loader)
+        except StopIteration:
+            self.next_batch = None
+            return
+        if self.stream is None:
+            self.next_batch = {k: v.to(self.device) for k, v in batch.items()}
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
+
+    def next(self):
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.next_batch
+        if batch is not None and self.stream is not None:
+            # 告知分配器这些张量在默认流上使用，防止被提前复用
+            for v in batch.values():
+                v.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return batch
+
+
 # build dataset with tokenizer
 train_dataset = Task2Dataset(df[:], tokenizer)
 dev_dataset = Task2Dataset(df_dev[:], tokenizer)
 
+# 使用多个GPU：通过 torchrun --nproc_per_node=N 启动，每个GPU一个进程
+distributed = 'LOCAL_RANK' in os.environ
+if distributed:
+    dist.init_process_group('nccl')
+    local_rank = int(os.environ['LOCAL_RANK'])
+    torch.cuda.set_device(local_rank)
+    device = torch.device('cuda', local_rank)
+    is_main_process = dist.get_rank() == 0
+else:
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    is_main_process = True
+
 # data_loader
-train_loader = DataLoader(train_dataset, batch_size=32, shuffle=True)
-dev_loader = DataLoader(dev_dataset, batch_size=32, shuffle=False)
+# 按长度分桶组batch，减少填充带来的无效计算
+train_sampler = BucketBatchSampler(train_dataset.lengths, batch_size=32,
+                                   num_replicas=dist.get_world_size() if distributed else 1,
+                                   rank=dist.get_rank() if distributed else 0)
+# 多worker预取 + 锁页内存，使数据拷贝与GPU计算重叠
+loader_kwargs = dict(num_workers=4, pin_memory=device.type == 'cuda', persistent_workers=True, prefetch_factor=2, collate_fn=partial(collate_fn, tokenizer=tokenizer))
+train_loader = DataLoader(train_dataset, batch_sampler=train_sampler, **loader_kwargs)
+dev_loader = DataLoader(dev_dataset, batch_size=32, shuffle=False, **loader_kwargs)
 
 # params
-optimizer = AdamW(model.parameters(), lr=5e-6)
-# 使用多个GPU
-if torch.cuda.device_count() > 1:
-    print(f"Let's use {torch.cuda.device_count()} GPUs!")
-    model = nn.DataParallel(model)
-
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 model.to(device)
-pearson = PearsonCorrCoef().to(device)
+# GPU上使用单kernel的fused AdamW，否则退回foreach实现；eps与weight_decay沿用transformers.AdamW的默认值
+use_fused = device.type == 'cuda'
+optimizer = AdamW([p for p in model.parameters() if p.requires_grad], lr=5e-6, eps=1e-6, weight_decay=0.0, fused=use_fused, foreach=not use_fused)
+# 保留未编译、未包装的模型用于保存state_dict
+base_model = model
+# 动态填充后各批次形状不同：按动态形状编译避免反复重编译，
+# 并关闭CUDA graphs，否则每种输入形状都要重新录制一张图
+model = torch.compile(model, mode='max-autotune-no-cudagraphs', dynamic=True)
+if distributed:
+    if is_main_process:
+        print(f"Let's use {dist.get_world_size()} GPUs!")
+    model = DDP(model, device_ids=[local_rank])
+# 只在主进程上评估，compute()时不做跨进程同步
+pearson = PearsonCorrCoef(sync_on_compute=False).to(device)
+# 混合精度训练(bf16)，仅在GPU上启用
+use_amp = device.type == 'cuda'
+scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
 
 # 设定基本的存储路径
 # 定义模型和损失函数
 num_classes =5
-loss_func = CombinedLoss(num_classes=5, alpha=0.8, beta=0.2,thegma =0.8)
+loss_func = CombinedLoss(num_classes=5, alpha=0.8, beta=0.2,thegma =0.8).to(device)
+loss_func = torch.compile(loss_func)
+@torch.inference_mode()
 def evaluate():
-    model.eval()
-    total_eval_accuracy = 0
-    y_pred = torch.tensor([0, 0]).to(device)
-    y_truth = torch.tensor([0, 0]).to(device)
-
+    # 只在主进程上评估，直接使用未包装的模型以避免DDP的集合通信
+    eval_model = model.module if distributed else model
+    eval_model.eval()
+    total_eval_accuracy = torch.zeros((), device=device)
+    pearson.reset()
+    preds_list = []
+    labels_list = []
 
     for batch in tqdm(dev_loader, desc="Evaluating"):
-        input_ids = batch['input_ids'].to(device)
-        attention_mask = batch['attention_mask'].to(device)
-        labels = batch['labels'].to(device)
+        input_ids = batch['input_ids'].to(device, non_blocking=True)
+        attention_mask = batch['attention_mask'].to(device, non_blocking=True)
+        labels = batch['labels'].to(device, non_blocking=True)
 
-        with torch.no_grad():
-            outputs = model(input_ids, attention_mask=attention_mask)
+        with torch.cuda.amp.autocast(enabled=use_amp, dtype=torch.bfloat16):
+            outputs = eval_model(input_ids, attention_mask=attention_mask)
 
         logits = outputs.logits
 
         preds = torch.argmax(logits, dim=1)
 
-        y_pred = torch.cat((y_pred, preds), dim=0)
-        y_truth = torch.cat((y_truth, labels), dim=0)
+        # 流式累积Pearson统计量
+        pearson.update(preds.float(), labels.float())
+        preds_list.append(preds)
+        labels_list.append(labels)
 
         accuracy = (preds == labels).float().mean()
-        total_eval_accuracy += accuracy.item()
+        total_eval_accuracy += accuracy
         # # 计算每个类别的正确计数和总计数
         # for i in range(num_classes[0]):
         #     correct_count[i] = torch.sum((preds == labels) & (labels == emotion_groups[i]))
@@ -203,11 +356,14 @@ def evaluate():
         #         print(f"Weighted accuracy for class {i}: {weighted_accuracy[i].item():.2f}")
         #     else:
         #         print(f"Class {i} does not appear in the labels.")
-    pearson_corr = pearson(y_pred.to(torch.float), y_truth.to(torch.float))
-    average_eval_accuracy = total_eval_accuracy / len(dev_loader)
+    pearson_corr = pearson.compute()
+    average_eval_accuracy = total_eval_accuracy.item() / len(dev_loader)
     
     result = pearson_corr.item()
     if  result > 0.63:
+        # 仅在需要保存结果时才拼接预测与标签
+        y_pred = torch.cat(preds_list, dim=0)
+        y_truth = torch.cat(labels_list, dim=0)
         preds_np = y_truth.detach().cpu().numpy()
         # 创建 DataFrame
         preds_df = pd.DataFrame(preds_np)
@@ -228,31 +384,43 @@ def evaluate():
 epochs = 10
 for epoch in range(epochs):
     model.train()
-    total_loss = 0
-
-    for batch in tqdm(train_loader, desc="Epoch {}".format(epoch + 1)):
-        
-        input_ids = batch['input_ids'].to(device)
-        attention_mask = batch['attention_mask'].to(device)
-        labels = batch['labels'].to(device)
+    train_sampler.set_epoch(epoch)
+    # 在GPU上累积loss，避免每步.item()引起的同步
+    total_loss = torch.zeros((), device=device)
+
+    prefetcher = DataPrefetcher(train_loader, device)
+    progress = tqdm(total=len(train_loader), desc="Epoch {}".format(epoch + 1))
+    batch = prefetcher.next()
+    while batch is not None:
+        input_ids = batch['input_ids']
+        attention_mask = batch['attention_mask']
+        labels = batch['labels']
 
         optimizer.zero_grad()
-        outputs = model(input_ids, attention_mask=attention_mask, labels=labels)
-        logits = outputs.logits
-        loss = loss_func(logits, labels)
-        loss.backward()
-        optimizer.step()
-        total_loss += loss.item()
-
-    if (epoch+1) % 1 == 0:
+        with torch.cuda.amp.autocast(enabled=use_amp, dtype=torch.bfloat16):
+            outputs = model(input_ids, attention_mask=attention_mask)
+            logits = outputs.logits
+            loss = loss_func(logits, labels)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        total_loss += loss.detach()
+        progress.update(1)
+        batch = prefetcher.next()
+    progress.close()
+    average_train_loss = total_loss.item() / len(train_loader)
+
+    if (epoch+1) % 1 == 0 and is_main_process:
         max_correlation = 0.62
         eval_res = evaluate()
 
+        print("Train loss:", average_train_loss)
         print("Dev eval result:", eval_res)
         if eval_res[1]>max_correlation:
-            torch.save(model, '/root/models/EmotionalPolarity' + str(eval_res) + "-" + str(epoch) + '.pth')
-
-
-
-
+            # 只保存参数，base_model未经DDP/torch.compile包装，键名与原始模型一致
+            torch.save(base_model.state_dict(), f'/root/models/EmotionalPolarity_{eval_res[1]:.4f}_ep{epoch}.pt')
+    if distributed:
+        dist.barrier()
 
+if distributed:
+    dist.destroy_process_group()